@@ -4,10 +4,19 @@ Note: This is just the underlying connection server. The actual Nayak protocol i
 """
 
 from flask import Flask, render_template
+from waitress import serve
+from array import array
+from collections import deque
+from urllib.parse import quote
+import asyncio
+import hashlib
+import heapq
+import queue
 import socket
 import threading
+import time
 from datetime import datetime
-import msgpack
+import msgspec
 import json
 import os
 
@@ -26,9 +35,52 @@ app = Flask(__name__)
 
 SOCKET_PORT = 5011
 HTTP_PORT = 5010
+HTTP_THREADS = 4
 
-# Extended users dictionary format: {username: {'conn': connection, 'commands': [], 'messages_received': []}}
+# Most bytes taken from a client's stream per read. This is taken from the
+# StreamReader's own buffer; the transport does the socket reads itself.
+READ_SIZE = 8192
+
+# Kernel send/receive buffer size for client sockets
+SOCKET_BUFFER_SIZE = 65536
+
+# Seconds between server ticks
+TICK_SECONDS = 0.1
+TICK_NANOSECONDS = int(TICK_SECONDS * 1_000_000_000)
+
+# Extended users dictionary format: {username: {'conn': connection, 'outq': queue, 'commands': deque, 'messages_received': {...}}}
+#
+# commands only keeps the last COMMAND_HISTORY commands in memory (and in
+# checkpoints). The full history goes to an append-only log file per user
+# in command_log_dir, written by the command log writer thread.
+#
+# messages_received is stored as parallel columns rather than a dict per
+# message: {'ts': array('d') of epoch seconds, 'from': [sender], 'msg': [message]}
+#
+# outq is an asyncio.Queue of bytes for the user's connection, used for
+# everything sent to a user by someone other than the user itself. It holds
+# at most OUTQ_MAXSIZE entries, so a user who stops reading cannot make the
+# server buffer everything sent to them.
+#
+# The event loop owns users, but the HTTP threads read it too, so adding
+# users and changing their lists happens under users_lock. Anything taken
+# from users for use outside the event loop is copied under the lock.
 users = {}
+users_lock = threading.RLock()
+
+COMMAND_HISTORY = 1024
+OUTQ_MAXSIZE = 64
+command_log_dir = None
+
+# (username, line) pairs for the command log writer thread, or
+# (username, None) once the user's session has ended
+command_log_queue = queue.Queue()
+
+# Usernames name each user's command log file. Quoting can triple their
+# UTF-8 length, so this keeps the file name well under the usual 255 byte
+# limit.
+USERNAME_MAX_BYTES = 64
+
 server_metadata = {
     'server_name': 'Nayak Server',
     'server_version': '0.1',
@@ -48,339 +100,805 @@ server_metadata = {
     ],
 }
 
-# Server ticks -- used for periodic tasks, incremented after every loop
-# at all nesting levels. This may increment multiple times per second
-# or not even once per second depending on server activity. It is likely
-# to increase multiple times between and during process of each command
-# received from each user.
-#
-# After hitting 65,565 (0xFFFF), it will wrap back to 0.
+# Fixed responses, encoded once instead of on every request
+BANNER = b''.join([
+    f'Welcome to the {server_metadata["server_name"]}.\r\n'.encode('utf-8'),
+    f'Server license: {server_metadata["server_license"]}\r\n'.encode('utf-8'),
+    f'License URL: {server_metadata["server_license_url"]}\r\n'.encode('utf-8'),
+    f'Alternative commercial licensing: {server_metadata["commercial_license"]}\r\n'.encode('utf-8'),
+    f'Alternative commercial licensing URL: {server_metadata["commercial_license_url"]}\r\n'.encode('utf-8'),
+    f'\r\nPlease login with the LOGIN command.\r\n'.encode('utf-8'),
+])
+HELP_TEXT = (b"Available commands:\r\n"
+             b"SEND <username> <message> - Send a message to a user\r\n"
+             b"WHO - List all online users\r\n"
+             b"HELP - Display this help message\r\n"
+             b"HELP ABOUT - Display information about the server\r\n"
+             b"QUIT - Disconnect from the server\r\n"
+             b"TICKS - Display the current server tick count\r\n"
+             b"TASKS - Display the current periodic tasks and their last run times\r\n")
+HELP_CONTRIBUTING = (b"Contributions to this project are welcome. Please read the CONTRIBUTING.md file for more information.\r\n"
+                     b"You can also visit the source code repository at: https://github.com/mindfulvector/Nayak-Server\r\n"
+                     b"If you have any questions, please contact us at nayak@fastmail.com\r\n")
+HELP_ABOUT = json.dumps(server_metadata).encode('utf-8')
+
+# The WHO response is rebuilt at most once every WHO_CACHE_TICKS, or
+# sooner when a user is added, so `Last active` may be up to a second old
+WHO_CACHE_TICKS = 10
+who_cache = None
+who_cache_ticks = 0
+
+# [second, ISO timestamp, ISO timestamp as UTF-8] for the current second
+iso_cache = [0, '', b'']
+
+# Server ticks -- used for periodic tasks. This is the number of whole
+# TICK_SECONDS periods elapsed on the monotonic clock since the server
+# started, refreshed by a timer on the event loop. A late timer does not
+# slow the clock down, it just makes the count jump by more than one.
 #
-# Periodic tasks are run when the server ticks are divisible by a
-# designated value.
+# Periodic tasks are run once the server ticks reach the task's next
+# run tick, after which the next run is scheduled `interval` ticks later.
 server_ticks = 0
+server_start_ns = time.monotonic_ns()
 
+# Min-heap of (next_run, task name, function, interval) so that
+# server_tick() only has to look at the first entry to know whether any
+# task is due, and has everything needed to run it in that entry
+task_heap = []
+
+# View of the periodic tasks for the TASKS command, updated as they run
 period_tasks = {}
 
 checkpoint_filename = None
 
+# Checkpoints append the records of changed users to a log next to the
+# snapshot. Once the log holds this many frames, the next checkpoint
+# compacts it into a new snapshot instead.
+CHECKPOINT_COMPACT_FRAMES = 1000
+checkpoint_log_filename = None
+checkpoint_log_frames = 0
+
+# Each snapshot gets the next generation number, and log frames carry the
+# generation of the snapshot they follow. Frames left over from an older
+# generation, by a crash before the log was emptied, are skipped on load.
+checkpoint_generation = 0
+
+# Users changed since the last checkpoint
+dirty_users = set()
+
+# Checkpoints are handed to the checkpoint writer thread so that disk I/O
+# never blocks the event loop. The writer keeps a hash of the bytes it
+# wrote to the snapshot and to the log, to check the files against.
+checkpoint_queue = queue.Queue(maxsize=4)
+CHECKPOINT_DIGEST_SIZE = 16
+
+# When the writer fails, it hands the users it could not write back
+# through these, under users_lock, for the next checkpoint to retry. A
+# failed snapshot also makes the next checkpoint compact again.
+checkpoint_failed_users = set()
+checkpoint_failed_compact = False
+checkpoint_snapshot_digest = None
+checkpoint_log_hash = None
+
+# Columns of a user's received messages, as stored in checkpoints. `from`
+# is a keyword, so that field is from_ in Python.
+class MessageLog(msgspec.Struct):
+    ts: list[float] = []
+    from_: list[str] = msgspec.field(default_factory=list, name='from')
+    msg: list[str] = []
+
+# Persistent part of a user record, i.e. everything except the connection
+class UserRecord(msgspec.Struct):
+    commands: list[list[str]] = []
+    messages_received: MessageLog | list[dict[str, str]] = msgspec.field(default_factory=MessageLog)  # Older checkpoints hold a list of dicts
+    first_login: str = ''
+    last_active: str = ''
+
+def coerce_checkpoint_value(obj):
+    # Only called for values msgspec cannot encode natively; store them as
+    # strings rather than failing the whole checkpoint
+    print(f'Coercing object for checkpoint: {obj} - {type(obj)}')
+    return str(obj)
+
+# The checkpoint buffer is reused across checkpoints so each one encodes
+# straight into memory that is already allocated. Only the checkpoint
+# writer thread uses it.
+checkpoint_encoder = msgspec.msgpack.Encoder(enc_hook=coerce_checkpoint_value)
+checkpoint_decoder = msgspec.msgpack.Decoder(tuple[int, dict[str, UserRecord]])
+checkpoint_frame_decoder = msgspec.msgpack.Decoder(tuple[int, str, UserRecord])
+# Checkpoints written before generations were added
+checkpoint_legacy_decoder = msgspec.msgpack.Decoder(dict[str, UserRecord])
+checkpoint_legacy_frame_decoder = msgspec.msgpack.Decoder(tuple[str, UserRecord])
+checkpoint_buffer = bytearray()
+
 def main():
     global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
+    global checkpoint_log_filename, command_log_dir
 
-    period_tasks['checkpoint'] = {
-        'interval': 600, # ticks
-        'last_run': -1,
-        'function': checkpoint
-    }
+    add_period_task('checkpoint', 600, checkpoint)
+    add_period_task('verify_checkpoint', 36000, verify_checkpoint)
 
     checkpoint_filename = os.getcwd() + '/checkpoint.msgpack'
-
-    threading.Thread(target=start_server).start()
+    checkpoint_log_filename = checkpoint_filename + '.log'
+    command_log_dir = os.getcwd() + '/commands'
+    os.makedirs(command_log_dir, exist_ok=True)
 
     now = datetime.now()
     print(f'Starting Nayak Server on port {SOCKET_PORT} with HTTP port {HTTP_PORT} at {now}...')
     load_checkpoint()
+    threading.Thread(target=checkpoint_writer, daemon=True).start()
+    threading.Thread(target=command_log_writer, daemon=True).start()
+
+    # The HTTP server (waitress, with its own pool of worker threads) blocks,
+    # so it gets a thread of its own. It is a daemon thread so that it does
+    # not keep the process alive after shutdown.
+    threading.Thread(target=serve, args=(app,),
+                     kwargs={'host': '127.0.0.1', 'port': HTTP_PORT, 'threads': HTTP_THREADS},
+                     daemon=True).start()
+
     try:
-        app.run(port=HTTP_PORT)
+        asyncio.run(start_server())
     except KeyboardInterrupt:
         now = datetime.now()
-        printf(f'Shutting down Nayak Server at {now}...')
-        checkpoint()
+        print(f'Shutting down Nayak Server at {now}...')
+        checkpoint(compact=True, block=True)
+        checkpoint_queue.join()
+        command_log_queue.join()
 
 def user_is_connected(username):
     global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
-    if ('conn' in users[username]) and (None != users[username]['conn']) and (-1 != users[username]['conn'].fileno()):
+    if ('conn' in users[username]) and (None != users[username]['conn']) and (not users[username]['conn'].is_closing()):
         return True
     else:
         users[username]['conn'] = None
         return False
 
+def add_period_task(task, interval, function):
+    global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
+    period_tasks[task] = {
+        'interval': interval, # ticks
+        'last_run': -1,
+        'next_run': server_ticks + interval,
+    }
+    heapq.heappush(task_heap, (server_ticks + interval, task, function, interval))
+
 def server_tick():
     global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
-    server_ticks += 1
+    server_ticks = (time.monotonic_ns() - server_start_ns) // TICK_NANOSECONDS
+
+    # Schedule the next tick first so a failing task does not stop the clock
+    asyncio.get_running_loop().call_later(TICK_SECONDS, server_tick)
+
+    while task_heap and task_heap[0][0] <= server_ticks:
+        next_run, task, function, interval = task_heap[0]
+        heapq.heapreplace(task_heap, (server_ticks + interval, task, function, interval))
+        info = period_tasks[task]
+        info['last_run'] = server_ticks
+        info['next_run'] = server_ticks + interval
+        function()
+
+def new_message_log():
+    return {'ts': array('d'), 'from': [], 'msg': []}
+
+def user_record(username):
+    # The columns are copied so the writer thread encodes a stable snapshot
+    # while the event loop keeps appending to the live ones
+    info = users[username]
+    messages = info['messages_received']
+    return UserRecord(
+        commands=list(info['commands']),
+        messages_received=MessageLog(ts=messages['ts'].tolist(), from_=messages['from'].copy(), msg=messages['msg'].copy()),
+        first_login=info['first_login'],
+        last_active=info['last_active'])
+
+def live_user(record):
+    # Inverse of user_record(), for records read back from a checkpoint
+    info = msgspec.structs.asdict(record)
+    info['commands'] = deque(record.commands, maxlen=COMMAND_HISTORY)
+    messages = record.messages_received
+    if type(messages) is list:
+        messages = MessageLog(ts=[datetime.fromisoformat(m['timestamp']).timestamp() for m in messages],
+                              from_=['' for m in messages],
+                              msg=[m['message'] for m in messages])
+    info['messages_received'] = {'ts': array('d', messages.ts),
+                                 'from': messages.from_,
+                                 'msg': messages.msg}
+    return info
+
+def checkpoint(compact=False, block=False):
+    global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
+    global checkpoint_log_frames, dirty_users, checkpoint_failed_compact
 
-    for task, info in period_tasks.items():
-        if (server_ticks % info['interval'] == 0):
-            info['last_run'] = server_ticks
-            info['function']()
+    # Pick up whatever the writer failed to write last time
+    with users_lock:
+        dirty_users.update(checkpoint_failed_users)
+        checkpoint_failed_users.clear()
+        retry_compact = checkpoint_failed_compact
+        checkpoint_failed_compact = False
 
-def is_serializable(obj):
-    try:
-        msgpack.packb(obj)
-        return True
-    except msgpack.PackException as E:
-        print(f'Cannot serialize object: {obj} - {type(obj)} - error: {E}')
-        return False
+    compact = compact or retry_compact or checkpoint_log_frames >= CHECKPOINT_COMPACT_FRAMES
+    if not compact and not dirty_users:
+        return  # Nothing changed since the last checkpoint
 
-def checkpoint():
-    global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
-    
-    # Notify connected users of checkpoint
-    timestamp = datetime.now()
+    timestamp = iso_now()
 
     print(f'[{timestamp}] Checkpoint to {checkpoint_filename}...');
 
+    # Normally only users changed since the last checkpoint are written, as
+    # frames appended to the log. Compaction rewrites the full snapshot.
+    with users_lock:
+        changed_users = users if compact else dirty_users
+        serializable_users = {username: user_record(username) for username in changed_users}
+
+    # Encoding and disk I/O happen on the checkpoint writer thread
+    try:
+        checkpoint_queue.put(('snapshot' if compact else 'log', timestamp, serializable_users), block=block)
+    except queue.Full:
+        # The writer is still busy with earlier checkpoints. Users stay dirty
+        # so the next checkpoint picks up their changes instead.
+        print(f'[{timestamp}] Checkpoint skipped, the checkpoint writer is behind.')
+        if retry_compact:
+            with users_lock:
+                checkpoint_failed_compact = True
+        return
+
+    dirty_users = set()
+    checkpoint_log_frames = 0 if compact else checkpoint_log_frames + len(serializable_users)
+
+    # Notify connected users of checkpoint, now that it is on its way
+    notification = b'[' + iso_now_bytes() + b'] SYSTEM-MESSAGE: Checkpoint.\r\n'
     for recipient in users:
         if user_is_connected(recipient):
-            users[recipient]['conn'].send(f'[{timestamp}] SYSTEM-MESSAGE: Checkpoint.\r\n'.encode('utf-8'))
-    
-    serializable_users = {}
-    for user in users:
-        serializable_user = {}
-        for key, value in users[user].items():
-            if 'conn' == key:
+            try:
+                users[recipient]['outq'].put_nowait(notification)
+            except asyncio.QueueFull:
+                pass  # The user is not reading anyway
+
+def verify_checkpoint():
+    global checkpoint_queue
+    try:
+        checkpoint_queue.put_nowait(('verify', iso_now(), None))
+    except queue.Full:
+        pass  # Try again next time rather than add to a backlog
+
+def write_all(fd, buf):
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd, view):]
+
+def write_checkpoint_log(serializable_users):
+    global checkpoint_log_filename
+
+    # Each frame is a 4-byte big-endian length followed by a msgpack
+    # encoded [generation, username, record]. All frames go into the buffer
+    # back to back, so they reach the log in a single write.
+    del checkpoint_buffer[:]
+    for username, record in serializable_users.items():
+        start = len(checkpoint_buffer)
+        checkpoint_encoder.encode_into([checkpoint_generation, username, record], checkpoint_buffer, start + 4)
+        checkpoint_buffer[start:start + 4] = (len(checkpoint_buffer) - start - 4).to_bytes(4, 'big')
+
+    fd = os.open(checkpoint_log_filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        size = os.fstat(fd).st_size
+        try:
+            write_all(fd, checkpoint_buffer)
+            os.fsync(fd)
+        except OSError:
+            # Don't leave part of a frame for later frames to be appended to
+            os.ftruncate(fd, size)
+            raise
+    finally:
+        os.close(fd)
+
+def write_checkpoint_snapshot(serializable_users):
+    global checkpoint_filename, checkpoint_log_filename, checkpoint_generation
+    global checkpoint_snapshot_digest, checkpoint_log_hash
+
+    # Write the new snapshot next to the old one and swap it in atomically,
+    # after which the log it replaces can be emptied. Until then the frames
+    # in the log are from the previous generation and are not replayed.
+    checkpoint_encoder.encode_into([checkpoint_generation + 1, serializable_users], checkpoint_buffer)
+    digest = hashlib.blake2b(checkpoint_buffer, digest_size=CHECKPOINT_DIGEST_SIZE).digest()
+    fd = os.open(checkpoint_filename + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        write_all(fd, checkpoint_buffer)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(checkpoint_filename + '.tmp', checkpoint_filename)
+    # The hashes follow each file as soon as it changes, so a failure
+    # between the two steps leaves both matching what is on disk
+    checkpoint_generation += 1
+    checkpoint_snapshot_digest = digest
+    os.close(os.open(checkpoint_log_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644))
+    checkpoint_log_hash = hashlib.blake2b(digest_size=CHECKPOINT_DIGEST_SIZE)
+
+def checkpoint_file_hash(filename):
+    # Hash of a checkpoint file's contents, empty if it does not exist yet
+    try:
+        with open(filename, 'rb') as file:
+            return hashlib.blake2b(file.read(), digest_size=CHECKPOINT_DIGEST_SIZE)
+    except FileNotFoundError:
+        return hashlib.blake2b(digest_size=CHECKPOINT_DIGEST_SIZE)
+
+def check_checkpoint(timestamp):
+    global checkpoint_filename, checkpoint_log_filename
+    global checkpoint_snapshot_digest, checkpoint_log_hash
+
+    # Check that the files on disk hold exactly the bytes written to them,
+    # without decoding them again
+    if checkpoint_file_hash(checkpoint_filename).digest() != checkpoint_snapshot_digest:
+        print(f'[{timestamp}] ERROR: Checkpoint failed. {checkpoint_filename} does not match what was written.')
+    if checkpoint_file_hash(checkpoint_log_filename).digest() != checkpoint_log_hash.digest():
+        print(f'[{timestamp}] ERROR: Checkpoint failed. {checkpoint_log_filename} does not match what was written.')
+
+    print(f'[{timestamp}] Checkpoint verification complete.')
+
+def checkpoint_writer():
+    global checkpoint_log_hash, checkpoint_failed_compact
+
+    while True:
+        job, timestamp, serializable_users = checkpoint_queue.get()
+        try:
+            if 'verify' == job:
+                check_checkpoint(timestamp)
                 continue
-            if type(value) is datetime:
-                serializable_user[key] = value.isoformat()
-            else:
-                if is_serializable(value):
-                    serializable_user[key] = value
-        serializable_users[user] = serializable_user
-    
-    #serializable_users = {username: {k: v for k, v in data.items() if k != 'conn'}
-    #                      for username, data in users.items()}
-
-    serializable_users_json = json.dumps(serializable_users)
-    print(f'[{timestamp}] serializable_users: {serializable_users_json}')
-    
-    with open(checkpoint_filename, 'wb') as file:
-        packed = msgpack.packb(serializable_users)
-        file.write(packed)
-
-    # Verify the file was written correctly
-    with open(checkpoint_filename, 'rb') as file:
-        packed = file.read()
-        packed_users = msgpack.unpackb(packed)
-        if packed_users:
-            # Loop over live users list and check that each is stored properly in the packed DB
-            for username, info in users.items():
-                if username not in packed_users:
-                    print(f'[{timestamp}] ERROR: Checkpoint failed. User `{username}` not found in packed DB.')
-                else:
-                    # Compare everything except the conn value which is transitory
-                    for k in info:
-                        try:
-                            if info[k] != packed_users[username][k]:
-                                print(f'[{timestamp}] ERROR: Checkpoint failed. User `{username}` {k} does not match.')
-                        except KeyError:
-                            if 'conn' != k:
-                                print(f'[{timestamp}] ERROR: Checkpoint failed. User `{username}` {k} does not EXIST.')   
 
+            serializable_users_json = msgspec.json.encode(serializable_users, enc_hook=coerce_checkpoint_value).decode('utf-8')
+            print(f'[{timestamp}] serializable_users: {serializable_users_json}')
 
-    print(f'[{timestamp}] Checkpoint complete.')
+            if 'snapshot' == job:
+                write_checkpoint_snapshot(serializable_users)
+            else:
+                write_checkpoint_log(serializable_users)
+                checkpoint_log_hash.update(checkpoint_buffer)
 
-def load_checkpoint():
-    global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
+            print(f'[{timestamp}] Checkpoint complete.')
+        except Exception as e:
+            print(f'[{timestamp}] ERROR: Checkpoint failed. {e}')
+            if 'verify' != job:
+                with users_lock:
+                    checkpoint_failed_users.update(serializable_users)
+                    if 'snapshot' == job:
+                        checkpoint_failed_compact = True
+        finally:
+            checkpoint_queue.task_done()
+
+def read_checkpoint():
+    global checkpoint_filename, checkpoint_log_filename
     try:
         with open(checkpoint_filename, 'rb') as file:
             packed = file.read()
-            users = msgpack.unpackb(packed)  # Unpack users data
+        # Unpack users data, validating it against the UserRecord schema
+        try:
+            generation, packed_users = checkpoint_decoder.decode(packed)
+        except msgspec.ValidationError:
+            generation, packed_users = 0, checkpoint_legacy_decoder.decode(packed)
+    except FileNotFoundError:
+        generation, packed_users = 0, {}  # Start empty if no checkpoint file is found
+
+    # Replay the records written to the log since the snapshot was taken
+    try:
+        with open(checkpoint_log_filename, 'rb') as file:
+            packed = file.read()
     except FileNotFoundError:
-        users = {}  # Initialize users if no checkpoint file is found
+        packed = b''
+
+    view = memoryview(packed)
+    pos = 0
+    frames = 0
+    while pos + 4 <= len(packed):
+        length = int.from_bytes(view[pos:pos + 4], 'big')
+        if pos + 4 + length > len(packed):
+            print(f'Ignoring incomplete frame at the end of {checkpoint_log_filename}.')
+            break
+        frame = view[pos + 4:pos + 4 + length]
+        try:
+            frame_generation, username, record = checkpoint_frame_decoder.decode(frame)
+        except msgspec.ValidationError:
+            frame_generation, (username, record) = 0, checkpoint_legacy_frame_decoder.decode(frame)
+        # Frames from before the snapshot are already included in it
+        if frame_generation >= generation:
+            packed_users[username] = record
+        frames += 1
+        pos += 4 + length
+
+    # pos is where the last complete frame ends
+    return packed_users, generation, frames, pos
+
+def load_checkpoint():
+    global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
+    global checkpoint_log_frames, checkpoint_snapshot_digest, checkpoint_log_hash
+    global checkpoint_generation
+
+    packed_users, checkpoint_generation, checkpoint_log_frames, log_end = read_checkpoint()
+    users = {username: live_user(record) for username, record in packed_users.items()}
+
+    # Drop an incomplete frame left by a crash mid-write, otherwise its
+    # length prefix would swallow the frames appended after it
+    if os.path.exists(checkpoint_log_filename) and os.path.getsize(checkpoint_log_filename) > log_end:
+        print(f'Truncating {checkpoint_log_filename} to its last complete frame.')
+        os.truncate(checkpoint_log_filename, log_end)
+
+    # Later writes are checked against the files as they were found
+    checkpoint_snapshot_digest = checkpoint_file_hash(checkpoint_filename).digest()
+    checkpoint_log_hash = checkpoint_file_hash(checkpoint_log_filename)
+
+def refresh_iso_cache(second):
+    iso_cache[0] = second
+    iso_cache[1] = datetime.fromtimestamp(second).isoformat()
+    iso_cache[2] = iso_cache[1].encode('utf-8')
+
+def iso_time(now):
+    # Timestamps have second resolution, so they are only formatted once a
+    # second and otherwise come straight from the cache
+    second = int(now)
+    if iso_cache[0] != second:
+        refresh_iso_cache(second)
+    return iso_cache[1]
+
+def iso_time_bytes(now):
+    # Same as iso_time(), already encoded for sending to clients
+    iso_time(now)
+    return iso_cache[2]
+
+def iso_now():
+    return iso_time(time.time())
+
+def iso_now_bytes():
+    return iso_time_bytes(time.time())
+
+def who_response():
+    global users, server_ticks, who_cache, who_cache_ticks
+
+    if who_cache is None or server_ticks - who_cache_ticks >= WHO_CACHE_TICKS:
+        response = [b"Online users:\r\n"]
+        append = response.append
+        num = 0
+        for user, info in users.items():
+            num += 1
+            append(f"#{num} - {user} - Last active: {info['last_active']}\r\n".encode('utf-8'))
+        who_cache = b''.join(response)
+        who_cache_ticks = server_ticks
+    return who_cache
 
 def generate_iac_packet(command, option):
     return bytes([IAC, command, option])
 
-def handle_client(conn, username):
-    global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
+def send_all(writer, *chunks):
+    # Hand all chunks of a response to the transport in one go, so they go
+    # out together instead of costing a send() each. The transport gathers
+    # them with sendmsg() where it supports that.
+    writer.writelines(chunks)
+
+def strip_iac(buf):
+    # Fast path: plain text without any telnet commands in it
+    if b'\xff' not in buf:
+        return buf
+
+    # Jump from one IAC byte to the next with bytes.find() and keep the
+    # plain slices in between
+    chunks = []
+    append = chunks.append
+    find = buf.find
+    pos = 0
+    while True:
+        iac = find(b'\xff', pos)
+        if iac == -1:
+            append(buf[pos:])
+            break
+        append(buf[pos:iac])
+        # Handle the IAC sequence
+        # For simplicity, we'll just skip the next two bytes
+        # In a full implementation, you should properly parse the command
+        pos = iac + 3
+    return b''.join(chunks)
+
+# Command handlers. Each one gets the user issuing the command, the command
+# split into at most three parts, the time the command was received (the
+# same clock read as its logged timestamp) and the reply list to add its
+# output to. A handler returns True to end the session.
+
+def command_send(username, command_parts, now, reply):
+    global users
+    if len(command_parts) < 2:
+        reply.append(b'ERROR: SEND needs a recipient. Usage: SEND <username> <message>\r\n')
+        return
+    recipient = command_parts[1]
+    message = command_parts[2] if len(command_parts) > 2 else ''     # The rest of the line is the message
+
+    if recipient in users:
+        if user_is_connected(recipient):
+            try:
+                users[recipient]['outq'].put_nowait(b'[' + iso_time_bytes(now) + b'] ' + f'{username}: {message}\r\n'.encode('utf-8'))
+            except asyncio.QueueFull:
+                # The recipient has stopped reading what they were sent
+                reply.append(f'ERROR: User `{recipient}` is not accepting messages.\r\n'.encode('utf-8'))
+                return
+            messages = users[recipient]['messages_received']
+            with users_lock:
+                messages['ts'].append(now)
+                messages['from'].append(username)
+                messages['msg'].append(message)
+            dirty_users.add(recipient)
+            reply.append(f'OK: Message sent to {recipient}.\r\n'.encode('utf-8'))
+        else:
+            reply.append(f'ERROR: User `{recipient}` is not online.\r\n'.encode('utf-8'))
+    else:
+        reply.append(f'ERROR: User `{recipient}` does not exist.\r\n'.encode('utf-8'))
+
+def command_who(username, command_parts, now, reply):
+    reply.append(who_response())
+
+def command_help(username, command_parts, now, reply):
+    if len(command_parts) > 1:
+        if command_parts[1] == 'CONTRIBUTING':
+            reply.append(HELP_CONTRIBUTING)
+        elif command_parts[1] == 'ABOUT':
+            reply.append(HELP_ABOUT)
+        else:
+            reply.append(f'ERROR: HELP topic not found. Some commands do not have additional documentation beyond the command definition in the HELP output. Type HELP for available commands and topics.\r\n'.encode('utf-8'))
+    else:
+        reply.append(HELP_TEXT)
 
-    users[username]['last_active'] = datetime.now().isoformat()
-    conn.send(f"\r\nUser {username} logged in.\r\n".encode('utf-8'))  # Login confirmation
+def command_ticks(username, command_parts, now, reply):
+    global server_ticks
+    reply.append(f'OK: Server ticks: {server_ticks}\r\n'.encode('utf-8'))
 
+def command_tasks(username, command_parts, now, reply):
+    global period_tasks
+    reply.append(b"Periodic tasks:\r\n")
+    for task, info in period_tasks.items():
+        reply.append(f"{task} - Interval: {info['interval']}, Last run: {info['last_run']}, Next run: {info['next_run']}\r\n".encode('utf-8'))
+
+def command_quit(username, command_parts, now, reply):
+    reply.append(f'OK: Goodbye.\r\n'.encode('utf-8'))
+    return True
+
+def command_unknown(username, command_parts, now, reply):
+    if command_parts[0] != '':
+        reply.append(f'ERROR: Command was not understood. Type HELP for available commands.\r\n'.encode('utf-8'))
+
+COMMANDS = {
+    'SEND': command_send,
+    'WHO': command_who,
+    'HELP': command_help,
+    'TICKS': command_ticks,
+    'TASKS': command_tasks,
+    'QUIT': command_quit,
+}
+
+async def send_outgoing(writer, outq):
+    # Deliver what other users queued for this connection
     while True:
-        server_tick()
+        data = await outq.get()
+        writer.write(data)
+        await writer.drain()
+
+async def read_line(reader, writer, line, reply):
+    # `line` holds the bytes received after the last complete command line,
+    # which may already contain the next one. Reads until it holds a
+    # complete line, echoing input back as it arrives, and returns that
+    # line decoded as UTF-8 (or None if the client goes away first). The
+    # rest stays in `line` for the next call.
+    newline = line.find(b'\n')
+    while newline == -1:
+        raw_data = await reader.read(READ_SIZE)
+        if not raw_data:
+            return None
+
+        # Drop telnet commands; what is left is echoed as is. Only the newly
+        # added bytes are searched for the newline.
+        data = strip_iac(raw_data)
+        scan_from = len(line)
+        line += data
+        newline = line.find(b'\n', scan_from)
+        if newline != -1:
+            reply.append(data)  # The last echo goes out with the reply
+        else:
+            writer.write(data)  # Echoing back the received data
+
+    received_data = line[:newline + 1].decode('utf-8', errors='replace')
+    del line[:newline + 1]
+    return received_data
+
+def open_command_log(username):
+    global command_log_dir
+    # Usernames come from clients, so they are quoted to be safe as a file
+    # name
+    return open(f'{command_log_dir}/{quote(username, safe="")}.log', 'a', encoding='utf-8')
+
+def command_log_writer():
+    # A user's log file stays open while their session lasts
+    files = {}
+    while True:
+        # Write everything queued since the last wakeup, then flush once
+        # per file rather than once per command
+        entries = [command_log_queue.get()]
         try:
-            received_data = ""
-            while not received_data.endswith("\n"):
-                server_tick()
-                raw_data = conn.recv(1024)
-                if not raw_data:
-                    break
-
-                processed_data = bytearray()
-                i = 0
-                while i < len(raw_data):
-                    server_tick()
-                    if raw_data[i] == 0xff:  # IAC byte
-                        # Handle the IAC sequence
-                        # For simplicity, we'll just skip the next two bytes
-                        # In a full implementation, you should properly parse the command
-                        i += 3
-                    else:
-                        processed_data.append(raw_data[i])
-                        i += 1
-
-                # Now decode the remaining data as UTF-8
-                data = processed_data.decode('utf-8')
-                conn.send(data.encode('utf-8'))  # Echoing back the received data
-                received_data += data
-
-            data = None
-
-            timestamp = datetime.now()
-            users[username]['last_active'] = timestamp.isoformat()  # Update last active time
-
-            command_parts = received_data.strip().split(' ')
-            command = command_parts[0]
-
-            if 'commands' not in users[username]:
-                users[username]['commands'] = []
-
-            # Tuples are deserialized as lists, which we must do because we need to be able to modify
-            # other lists in the structure, so we need to not use tuples at all if we want the
-            # structure to match when reloaded from disk
-            users[username]['commands'].append([timestamp.isoformat(), received_data])
-
-            if command == 'SEND':
-                recipient = command_parts[1]
-                message = ' '.join(command_parts[2:])       # Get remaining parts of the command as the message
-
-                if recipient in users:
-                    if user_is_connected(recipient):
-                        users[recipient]['messages_received'].append({'timestamp': timestamp, 'message': message})
-                        users[recipient]['conn'].send(f'[{timestamp}] {username}: {message}\r\n'.encode('utf-8'))
-                        conn.send(f'OK: Message sent to {recipient}.\r\n'.encode('utf-8'))
-                    else:
-                        conn.send(f'ERROR: User `{recipient}` is not online.\r\n'.encode('utf-8'))
+            while True:
+                entries.append(command_log_queue.get_nowait())
+        except queue.Empty:
+            pass
+
+        written = set()
+        for username, entry in entries:
+            try:
+                if entry is None:
+                    written.discard(username)
+                    if username in files:
+                        files.pop(username).close()
                 else:
-                    conn.send(f'ERROR: User `{recipient}` does not exist.\r\n'.encode('utf-8'))
-            elif command == 'WHO':
-                response = "Online users:\r\n"
-                num = 0
-                for user, info in users.items():
-                    num += 1
-                    response += f"#{num} - {user} - Last active: {info['last_active']}\r\n"
-                conn.send(response.encode('utf-8'))
-            elif command == 'HELP':
-                if len(command_parts) > 1:
-                    if command_parts[1] == 'CONTRIBUTING':
-                        response = "Contributions to this project are welcome. Please read the CONTRIBUTING.md file for more information.\r\n"
-                        response += "You can also visit the source code repository at: https://github.com/mindfulvector/Nayak-Server\r\n"
-                        response += "If you have any questions, please contact us at nayak@fastmail.com\r\n"
-                        conn.send(response.encode('utf-8'))
-                    elif command_parts[1] == 'ABOUT':
-                        response = json.dumps(server_metadata)
-                        conn.send(response.encode('utf-8'))
-                    else:
-                        conn.send(f'ERROR: HELP topic not found. Some commands do not have additional documentation beyond the command definition in the HELP output. Type HELP for available commands and topics.\r\n'.encode('utf-8'))
-                else:
-                    response = "Available commands:\r\n"
-                    response += "SEND <username> <message> - Send a message to a user\r\n"
-                    response += "WHO - List all online users\r\n"
-                    response += "HELP - Display this help message\r\n"
-                    response += "HELP ABOUT - Display information about the server\r\n"
-                    response += "QUIT - Disconnect from the server\r\n"
-                    response += "TICKS - Display the current server tick count\r\n"
-                    response += "TASKS - Display the current periodic tasks and their last run times\r\n"
-                    conn.send(response.encode('utf-8'))
-            elif command == 'TICKS':
-                conn.send(f'OK: Server ticks: {server_ticks}\r\n'.encode('utf-8'))
-            elif command == 'TASKS':
-                response = "Periodic tasks:\r\n"
-                for task, info in period_tasks.items():
-                    response += f"{task} - Interval: {info['interval']}, Last run: {info['last_run']}\r\n"
-                conn.send(response.encode('utf-8'))
-            elif command == 'QUIT':
-                users[username]['conn'] = None
-                conn.send(f'OK: Goodbye.\r\n'.encode('utf-8'))
-                conn.close()
-                break
-            elif command != '':
-                conn.send(f'ERROR: Command was not understood. Type HELP for available commands.\r\n'.encode('utf-8'))
+                    if username not in files:
+                        files[username] = open_command_log(username)
+                    files[username].write(entry)
+                    written.add(username)
+            except OSError as e:
+                print(f'ERROR: Command log for `{username}` failed. {e}')
+        for username in written:
+            try:
+                files[username].flush()
+            except OSError as e:
+                print(f'ERROR: Command log for `{username}` failed. {e}')
+
+        for entry in entries:
+            command_log_queue.task_done()
+
+async def handle_client(reader, writer, username, line):
+    global users, server_ticks, period_tasks, server_metadata, checkpoint_filename
 
-            # [Rest of the existing code]
-        except Exception as e:
-            print(f"Error: {e}")
-            break
+    users[username]['last_active'] = iso_now()
+    dirty_users.add(username)
 
-def start_server():
-    global users
+    writer.write(f"\r\nUser {username} logged in.\r\n".encode('utf-8'))  # Login confirmation
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(('localhost', SOCKET_PORT))
-    server.listen()
+    sender = asyncio.create_task(send_outgoing(writer, users[username]['outq']))
 
-    while True:
-        server_tick()
-        conn, addr = server.accept()
-        
-        # Send WILL ECHO command to client
-        conn.send(generate_iac_packet(WILL, ECHO))
-
-        conn.send(f'Welcome to the {server_metadata["server_name"]}.\r\n'.encode('utf-8'))
-        conn.send(f'Server license: {server_metadata["server_license"]}\r\n'.encode('utf-8'))
-        conn.send(f'License URL: {server_metadata["server_license_url"]}\r\n'.encode('utf-8'))
-        conn.send(f'Alternative commercial licensing: {server_metadata["commercial_license"]}\r\n'.encode('utf-8'))
-        conn.send(f'Alternative commercial licensing URL: {server_metadata["commercial_license_url"]}\r\n'.encode('utf-8'))
-        conn.send(f'\r\nPlease login with the LOGIN command.\r\n'.encode('utf-8'))
-
-        # Wait for LOGIN command
-        received_data = ""
-        while not received_data.endswith("\n"):
-            server_tick()
-            raw_data = conn.recv(1024)
-            if not raw_data:
-                break
+    # Looked up once per session rather than once per command. The user's
+    # record and its commands deque stay the same objects while connected.
+    info = users[username]
+    commands = info['commands']
+    log_command = command_log_queue.put_nowait
+    dispatch = COMMANDS.get
+    try:
+        while True:
+            try:
+                # Everything sent back for this command, written at once at the end
+                reply = []
+
+                received_data = await read_line(reader, writer, line, reply)
+                if received_data is None:
+                    # Client went away without sending QUIT
+                    break
 
-            processed_data = bytearray()
-            i = 0
-            while i < len(raw_data):
-                server_tick()
-                if raw_data[i] == 0xff:  # IAC byte
-                    # Handle the IAC sequence
-                    # For simplicity, we'll just skip the next two bytes
-                    # In a full implementation, you should properly parse the command
-                    i += 3
-                else:
-                    processed_data.append(raw_data[i])
-                    i += 1
+                now = time.time()
+                timestamp = iso_time(now)
+                info['last_active'] = timestamp  # Update last active time
 
-                # Now decode the remaining data as UTF-8
-                data = processed_data.decode('utf-8')
+                # The message of a SEND stays in one piece as the third part
+                command_parts = received_data.strip().split(' ', 2)
+                command = command_parts[0]
 
-                if not data:
+                log_command((username, timestamp + '\t' + received_data.rstrip('\r\n') + '\n'))
+
+                # Tuples are deserialized as lists, which we must do because we need to be able to modify
+                # other lists in the structure, so we need to not use tuples at all if we want the
+                # structure to match when reloaded from disk
+                with users_lock:
+                    commands.append([timestamp, received_data])
+                dirty_users.add(username)
+
+                if dispatch(command, command_unknown)(username, command_parts, now, reply):
+                    send_all(writer, *reply)
                     break
-                conn.send(data.encode('utf-8'))  # Echoing back the received data
-                received_data += data
-
-        data = None
-
-        # Process received_data only if it's not empty and ends with a newline
-        if received_data:
-            received_data = received_data.strip()  # Removing the newline character
-            cmd = received_data.split(' ')
-            if (cmd[0] != 'LOGIN'):
-                conn.send('ERROR: You must first login to the server. Bye.\r\n'.encode('utf-8'))
-                conn.close()
-                continue
-            else:
-                username = cmd[1]
-                if (len(username) < 4):
-                    conn.send('ERROR: Username must be at least 4 characters long. Bye.\r\n'.encode('utf-8'))
-                    conn.close()
-                    continue
-                if username in users:       # Existing user
-                    # Check if existing connection is still active
-                    if not user_is_connected(username):
-                        # Connection is inactive, update with new connection
-                        users[username]['conn'] = conn
-                    else:
-                        # Connection is active, deny login
-                        conn.send('ERROR: Username is already online. Bye.\r\n'.encode('utf-8'))
-                        conn.close()
-                        continue
-                else:                       # New user
-                    users[username] = {'conn': conn, 'commands': [], 'messages_received': [],
-                               'first_login': datetime.now().isoformat(),
-                               'last_active': datetime.now().isoformat()}
-                    checkpoint()  # Save new user immediately
-                thread = threading.Thread(target=handle_client, args=(conn, username))
-                thread.start()
 
+                send_all(writer, *reply)
+                await writer.drain()
+            except Exception as e:
+                print(f"Error: {e}")
+                break
+    finally:
+        sender.cancel()
+        log_command((username, None))
+        # A newer login may already have taken over this username
+        if users[username].get('conn') is writer:
+            users[username]['conn'] = None
+            users[username]['outq'] = None
+        writer.close()
+
+async def accept_client(reader, writer):
+    global users, who_cache
+
+    # Traffic is small interactive messages, so send them right away rather
+    # than letting Nagle's algorithm hold them back waiting for more data
+    conn = writer.get_extra_info('socket')
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
+    send_all(writer, generate_iac_packet(WILL, ECHO), BANNER)  # Send WILL ECHO command to client
+
+    # Wait for LOGIN command. Anything received after it stays in `line`
+    # for handle_client.
+    line = bytearray()
+    reply = []
+    received_data = await read_line(reader, writer, line, reply)
+    send_all(writer, *reply)
+
+    # Process the line only if it is complete
+    if received_data is None:
+        writer.close()
+        return
+
+    received_data = received_data.strip()  # Removing the newline character
+    cmd = received_data.split(' ')
+    if (cmd[0] != 'LOGIN'):
+        writer.write('ERROR: You must first login to the server. Bye.\r\n'.encode('utf-8'))
+        writer.close()
+        return
+
+    if (len(cmd) < 2):
+        writer.write('ERROR: Usage: LOGIN <username>. Bye.\r\n'.encode('utf-8'))
+        writer.close()
+        return
+
+    username = cmd[1]
+    if (len(username) < 4):
+        writer.write('ERROR: Username must be at least 4 characters long. Bye.\r\n'.encode('utf-8'))
+        writer.close()
+        return
+    if (len(username.encode('utf-8')) > USERNAME_MAX_BYTES):
+        writer.write(f'ERROR: Username must be at most {USERNAME_MAX_BYTES} bytes long. Bye.\r\n'.encode('utf-8'))
+        writer.close()
+        return
+    if username in users:       # Existing user
+        # Check if existing connection is still active
+        if not user_is_connected(username):
+            # Connection is inactive, update with new connection
+            users[username]['conn'] = writer
+            users[username]['outq'] = asyncio.Queue(maxsize=OUTQ_MAXSIZE)
+        else:
+            # Connection is active, deny login
+            writer.write('ERROR: Username is already online. Bye.\r\n'.encode('utf-8'))
+            writer.close()
+            return
+    else:                       # New user
+        with users_lock:
+            users[username] = {'conn': writer, 'outq': asyncio.Queue(maxsize=OUTQ_MAXSIZE),
+                       'commands': deque(maxlen=COMMAND_HISTORY), 'messages_received': new_message_log(),
+                       'first_login': iso_now(),
+                       'last_active': iso_now()}
+        who_cache = None
+        dirty_users.add(username)
+        checkpoint()  # Save new user immediately
+
+    await handle_client(reader, writer, username, line)
+
+async def start_server():
+    global server_start_ns
+
+    server_start_ns = time.monotonic_ns()
+    loop = asyncio.get_running_loop()
+    loop.call_later(TICK_SECONDS, server_tick)
+
+    # One event loop multiplexes every client connection; each client is a
+    # coroutine instead of an OS thread with its own stack.
+    server = await asyncio.start_server(accept_client, 'localhost', SOCKET_PORT, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+@app.template_filter('isotime')
+def isotime(ts):
+    return datetime.fromtimestamp(ts).isoformat(timespec='seconds')
 
 @app.route('/')
 def index():
-    return render_template('index.html', users=users)
+    with users_lock:
+        snapshot = {username: user_record(username) for username in users}
+    return render_template('index.html', users=snapshot)
 
 if __name__ == '__main__':
     main()